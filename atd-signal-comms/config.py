@@ -79,8 +79,8 @@ SCHEMA = {
     },
     "location_name": {"type": "string", "nullable": True},
     "location_id": {"type": "string", "nullable": True},
-    "status_code": {"type": "integer", "allowed": STATUS_CODES.keys()},
-    "status_desc": {"type": "string", "allowed": STATUS_CODES.values()},
+    "status_code": {"type": "integer", "allowed": frozenset(STATUS_CODES.keys())},
+    "status_desc": {"type": "string", "allowed": frozenset(STATUS_CODES.values())},
     "delay": {"type": "integer", "nullable": True},
     "timestamp": {
         "type": "string",
@@ -1,49 +1,91 @@
-from datetime import datetime, timezone
 import logging
+import operator
 import socket
 
-import aioping
-
-from settings import DATE_FORMAT_SOCRATA, STATUS_CODES
+from settings import STATUS_CODES
 from config import SCHEMA
 
 logger = logging.getLogger("__main__")
 
+# schema keys and a getter which fetches all of them from a Device in one call
+_SCHEMA_KEYS = tuple(SCHEMA.keys())
+_ATTRS = operator.attrgetter(*_SCHEMA_KEYS)
+
+# status descriptions, indexed by status code + _STATUS_OFFSET
+_STATUS_OFFSET = -min(STATUS_CODES)
+_STATUS_DESC = tuple(STATUS_CODES[i - _STATUS_OFFSET] for i in range(len(STATUS_CODES)))
+
+# Device fields: schema fields plus the ping timeout. status_desc is derived from
+# status_code
+_FIELDS = tuple(k for k in _SCHEMA_KEYS if k != "status_desc") + ("timeout",)
+
+def _make_field_setter(fields):
+    """Generate a method which assigns each field from a keyword arg, defaulting to
+    None.
+
+    The method body is a straight-line `self.<field> = <field>` per field, which is
+    the same approach the stdlib dataclasses module uses to generate `__init__`.
+
+    Args:
+        fields (tuple): the field names
+
+    Returns:
+        function: the method
+    """
+    args = ", ".join(f"{field}=None" for field in fields)
+    body = "\n".join(f"    self.{field} = {field}" for field in fields)
+    namespace = {}
+    exec(f"def _set_fields(self, *, {args}):\n{body}\n", namespace)
+    return namespace["_set_fields"]
+
 
 class Device:
     """A container for a single http-enabled device."""
+
+    # no per-instance __dict__
+    __slots__ = _FIELDS
+
+    # assigns all fields from keyword args. unset fields default to None
+    _set_fields = _make_field_setter(_FIELDS)
+
     def __repr__(self):
         return f"<{self.device_type} '{self.ip_address}'>"
 
-    def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+    def __init__(self, batch_ts_ms, **kwargs):
+        """
+        Args:
+            batch_ts_ms (int): the millisecond timestamp of the comm check run, which
+                is used to form the record ID
+        Raises:
+            ValueError if required attributes are missing
+        """
+        self._set_fields(**kwargs)
         # verify required fields present
         self._raise_if_invalid()
         # set additional atttributes
-        self.id = self._get_id()
+        self.id = self._get_id(batch_ts_ms)
         self.status_code = 0
 
-    async def ping(self):
+    async def ping(self, pinger):
         """Async (non-blocking) attempt to ping the device's IP address.
 
         All exceptions are supressed and translated to the device's status_code
         and status_desc attributes.
 
         Side-effects:
-            - Set self.timestamp to the current time
             - Set self.dellay to the ping delay in ms (if successful)
             - Set self.status_code and self.status_desc accordingly
+        Args:
+            pinger (pinger.IcmpPinger): the shared ICMP pinger
         Returns:
             int: the device's status code.
         """
-        logger.debug(f"Ping {self.ip_address}")
-        self.timestamp = datetime.now(timezone.utc).strftime(DATE_FORMAT_SOCRATA)
+        logger.debug("Ping %s", self.ip_address)
         try:
-            delay = await aioping.ping(self.ip_address, timeout=self.timeout) * 1000
+            delay = await pinger.ping(self.ip_address, self.timeout) * 1000
             self.delay = int(delay)
             self.status_code = 1
-            logger.debug(f"Success: {self.ip_address} in {self.delay}ms")
+            logger.debug("Success: %s in %sms", self.ip_address, self.delay)
         except TimeoutError:
             self.status_code = -1
             pass
@@ -55,21 +97,24 @@ class Device:
             # unknown error
             self.status_code = -3
             pass
-        self.status_desc = STATUS_CODES[self.status_code]
         self.status_code < 0 and logger.warning(
             f"Ping {self.ip_address} failed with code {self.status_code}: {self.status_desc}"
         )
         return self.status_code
 
     @property
-    def __dict__(self):
+    def status_desc(self):
+        """str: the description of the device's status code"""
+        return _STATUS_DESC[self.status_code + _STATUS_OFFSET]
+
+    def to_record(self):
         """Return a dict of instance properties. Only return keys defined in schema, which
         allows us to exclude extra instance properties, .e.g timeout.
 
         Returns:
             dict: instance properties
         """
-        return {s: getattr(self, s, None) for s in SCHEMA.keys()}
+        return dict(zip(_SCHEMA_KEYS, _ATTRS(self)))
 
     def _raise_if_invalid(
         self, required_attrs=["ip_address", "device_id", "device_type"]
@@ -80,21 +125,15 @@ class Device:
             ValueError if required attributes are Falsey
         """
         for attr in required_attrs:
-            try:
-                assert getattr(self, attr)
-            except AssertionError:
+            if not getattr(self, attr, None):
                 raise ValueError(f"Missing value for field {attr}")
-            except AttributeError:
-                raise ValueError(f"Missing required field {attr}")
 
-    def _get_id(self) -> str:
+    def _get_id(self, batch_ts_ms) -> str:
         """Format the ID of the comm status record
 
         Args:
-            device_id (int): the device's unique ID
-            dt (datetime.datetime): a datetime instance
+            batch_ts_ms (int): the millisecond timestamp of the comm check run
         Returns:
             str: the formatted record ID
         """
-        now = datetime.now(timezone.utc)
-        return f"{self.device_id}_{self.device_type}_{int(now.timestamp() * 1000)}"
+        return f"{self.device_id}_{self.device_type}_{batch_ts_ms}"
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import socket
+import struct
+
+logger = logging.getLogger("__main__")
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct("!BBHHH")
+# replies to every ping in flight queue in the one socket's receive buffer until the
+# event loop reads them. the kernel's default buffer holds only ~128 replies
+RCVBUF_DEFAULT = 4 * 1024 * 1024
+# estimated bytes of receive buffer used by each queued echo reply, including kernel
+# overhead. measured on loopback; the actual overhead varies by network driver
+REPLY_BUFFER_BYTES = 1664
+
+
+def checksum(data):
+    """Compute the internet checksum (RFC 1071) of an ICMP packet.
+
+    Args:
+        data (bytes): the packet bytes
+
+    Returns:
+        int: the 16-bit checksum
+    """
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpPinger:
+    """A single ICMP socket shared by every ping in a run.
+
+    Echo requests for all devices are sent through one socket and replies are
+    dispatched back to the awaiting coroutine by ICMP sequence number. This avoids
+    opening (and closing) a new raw socket for every ping.
+
+    Use as a context manager from within a running event loop:
+
+        with IcmpPinger() as pinger:
+            delay = await pinger.ping("10.0.0.1", timeout=5)
+    """
+
+    def __repr__(self):
+        return f"<IcmpPinger ident={self.ident} pending={len(self._pending)}>"
+
+    def __init__(self, rcvbuf=RCVBUF_DEFAULT):
+        self.ident = os.getpid() & 0xFFFF
+        self.rcvbuf = rcvbuf
+        self._seq = 0
+        # seq -> (destination address, send time, asyncio.Future)
+        self._pending = {}
+        self._sock = None
+        self._raw = True
+        self._loop = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        """Open the ICMP socket and register it with the running event loop.
+
+        A raw socket is preferred. If the process lacks the privileges to open one, an
+        unprivileged ICMP datagram socket is used instead (Linux, see
+        `net.ipv4.ping_group_range`).
+        """
+        self._loop = asyncio.get_running_loop()
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self._raw = True
+        except PermissionError:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self._raw = False
+        sock.setblocking(False)
+        # the kernel caps the size at net.core.rmem_max. getsockopt reports the size
+        # actually granted, which includes the kernel's bookkeeping overhead
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        self.rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._sock = sock
+        self._loop.add_reader(sock.fileno(), self._on_readable)
+        logger.debug(
+            f"Opened {'raw' if self._raw else 'datagram'} ICMP socket with a "
+            f"{self.rcvbuf} byte receive buffer"
+        )
+
+    @property
+    def max_in_flight(self):
+        """int: the estimated number of pings whose replies fit in the socket's receive
+        buffer. Replies beyond this may be dropped if they arrive before the buffer is
+        read.
+        """
+        return max(self.rcvbuf // REPLY_BUFFER_BYTES, 1)
+
+    def close(self):
+        """Unregister and close the socket. Any outstanding pings are cancelled."""
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        for _, _, future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    async def ping(self, host, timeout):
+        """Send a single ICMP echo request and wait for its reply.
+
+        Args:
+            host (str): the IPv4 address or hostname to ping
+            timeout (int): seconds to wait for a reply
+
+        Raises:
+            TimeoutError: if no reply is received within the timeout
+            socket.gaierror: if the host name cannot be resolved
+
+        Returns:
+            float: the round trip delay in seconds
+        """
+        addr = await self._resolve(host)
+        seq = self._next_seq()
+        future = self._loop.create_future()
+        self._pending[seq] = (addr, self._loop.time(), future)
+        try:
+            self._sock.sendto(self._build_packet(seq), (addr, 0))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Ping {host} timed out after {timeout}s")
+        finally:
+            self._pending.pop(seq, None)
+
+    async def _resolve(self, host):
+        try:
+            # replies come from the canonical dotted-quad form of the address, so
+            # normalize any other form inet_aton accepts (e.g. 127.1 or 0x7f.0.0.1)
+            return socket.inet_ntoa(socket.inet_aton(host))
+        except OSError:
+            pass
+        info = await self._loop.getaddrinfo(
+            host, None, family=socket.AF_INET, type=socket.SOCK_RAW
+        )
+        return info[0][4][0]
+
+    def _next_seq(self):
+        """Return the next ICMP sequence number which is not awaiting a reply"""
+        for _ in range(0x10000):
+            self._seq = (self._seq + 1) & 0xFFFF
+            if self._seq not in self._pending:
+                return self._seq
+        raise RuntimeError("No ICMP sequence numbers available")
+
+    def _build_packet(self, seq):
+        payload = struct.pack("!d", self._loop.time())
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+        chk = checksum(header + payload)
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, chk, self.ident, seq)
+        return header + payload
+
+    def _on_readable(self):
+        """Event loop reader callback. Drain the socket and resolve matching pings."""
+        while True:
+            try:
+                data, (addr, _) = self._sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug(f"ICMP socket read failed: {e}")
+                return
+
+            # raw sockets include the IP header; datagram sockets do not
+            offset = (data[0] & 0x0F) * 4 if self._raw else 0
+            if len(data) < offset + ICMP_HEADER.size:
+                continue
+
+            icmp_type, _, _, ident, seq = ICMP_HEADER.unpack_from(data, offset)
+            if icmp_type != ICMP_ECHO_REPLY:
+                continue
+            # the kernel rewrites the ident of unprivileged datagram sockets
+            if self._raw and ident != self.ident:
+                continue
+
+            pending = self._pending.get(seq)
+            if not pending:
+                continue
+            dest, sent_at, future = pending
+            if dest != addr or future.done():
+                continue
+            future.set_result(self._loop.time() - sent_at)
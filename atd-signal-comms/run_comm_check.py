@@ -6,18 +6,33 @@ import argparse
 import asyncio
 from collections import Counter
 from datetime import datetime, timezone
-import json
 import logging
+import operator
 import os
+import time
 
 
 import boto3
-import knackpy
+import fastjsonschema
+from knackpy.fields import FieldDef
+import orjson
 from pypgrest import Postgrest
 
+try:
+    import uvloop
+except ImportError:
+    # fall back to the default asyncio event loop
+    uvloop = None
+
 from device import Device
+from pinger import IcmpPinger
 from config import CONFIG
-from settings import MAX_ATTEMPTS, NUM_WORKERS_DEFAULT, TIMEOUT_DEFAULT
+from settings import (
+    MAX_ATTEMPTS,
+    NUM_WORKERS_DEFAULT,
+    RETRY_BACKOFF,
+    TIMEOUT_DEFAULT,
+)
 import utils
 
 PGREST_JWT = os.getenv("PGREST_JWT")
@@ -27,45 +42,79 @@ AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 BUCKET = os.getenv("BUCKET")
 
+# ping status codes which end retries: online, invalid host name, unknown exception
+STOP_CODES = frozenset({1, -2, -3})
+
 
-async def worker(queue):
+async def ping_with_retry(device, pinger, semaphore):
     """
-    Looping async queue worker.
+    Ping a device, retrying on timeout, and update its instance properties with the
+    outcome.
+
+    Concurrency is bounded by the semaphore, i.e. by the number of workers. Retries
+    are delayed with exponential backoff, during which the device does not hold a
+    worker.
+
+    Args:
+        device (Device): the Device instance to ping
+        pinger (pinger.IcmpPinger): the ICMP pinger shared by all pings
+        semaphore (asyncio.Semaphore): limits the number of concurrent pings
+    """
+    logger.debug(device)
+    attempts = 0
+    while attempts <= MAX_ATTEMPTS and device.status_code not in STOP_CODES:
+        """Attempt to ping device until max atttempts is reached or staus code is:
+         1 (online)
+        -2 (invalid host name)
+        -3 (unknown exception)
+
+        In other words, retry on timeout up to max attempts
+        """
+        if attempts:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempts - 1))
+        attempts += 1
+        async with semaphore:
+            await device.ping(pinger)
 
-    Fetches new Device tasks from queue, attempts to ping the device IP, and updates
-    instance properties with the outcome.
+
+def get_field_mapper(fields):
+    """Build a function which translates a knack record to Device kwargs.
+
+    The field mappings are resolved once, so that each record is translated with a
+    single itemgetter call rather than a dict lookup per field.
 
     Args:
-        queue (asyncio.Queue): asyncio.Queue with Device instances
+        fields (dict): a dict of field mappings use to replace knack field names with
+            humanized names (see config.py)
 
     Returns:
-        asyncio.CancelledError: If the worker is cancelled
+        function: a function which accepts a knack record dict and returns a dict of
+            humanized field names and values. Fields absent from the record are None.
     """
-    while True:
-        device = await queue.get()
-        logger.debug(device)
-        attempts = 0
-        while attempts <= MAX_ATTEMPTS and device.status_code not in [1, -2, -3]:
-            """Attempt to ping device until max atttempts is reached or staus code is:
-             1 (online)
-            -2 (invalid host name)
-            -3 (unknown exception)
-
-            In other words, retry on timeout up to max attempts
-            """
-            attempts += 1
-            await device.ping()
-        queue.task_done()
-
-
-def construct_device(device, device_type, fields, timeout):
+    out_keys, in_keys = zip(*fields.items())
+    getter = operator.itemgetter(*in_keys)
+
+    def map_fields(record):
+        try:
+            values = getter(record)
+        except KeyError:
+            # at least one field is absent from the record
+            values = [record.get(key) for key in in_keys]
+        return dict(zip(out_keys, values))
+
+    return map_fields
+
+
+def construct_device(device, device_type, map_fields, timeout, batch_ts_ms):
     """Create a Device instance
 
     Args:
         device (ditc): a dict of knack device asset data
         device_type (str): The device type
-        fields (dict): a dict of field mappings use to replace knack field names with
-            humanized names (see config.py)
+        map_fields (function): translates knack field names to humanized names (see
+            get_field_mapper)
+        timeout (int): the ping timeout in seconds
+        batch_ts_ms (int): the millisecond timestamp of the comm check run
 
     Raises:
         ValueError: if ip_address or device_id fields are null or absent from Device kwargs
@@ -73,33 +122,56 @@ def construct_device(device, device_type, fields, timeout):
     Returns:
         Device: a Device instance
     """
-    device_kwargs = {key: device.get(value) for key, value in fields.items()}
+    device_kwargs = map_fields(device)
     device_kwargs["device_type"] = device_type
     device_kwargs["timeout"] = timeout
-    return Device(**device_kwargs)
+    return Device(batch_ts_ms, **device_kwargs)
 
 
-def get_device_records(container, postgrest):
+def get_record_keys(fields):
+    """Get the Knack record keys which are needed to construct Devices.
+
+    Knack records carry a formatted and a raw (`<field>_raw`) value for each field.
+    knackpy formats fields from their raw value, so both are needed.
+
+    Args:
+        fields (dict): a dict of field mappings (see config.py)
+
+    Returns:
+        list: a list of Knack record keys
+    """
+    keys = []
+    for key in fields.values():
+        keys.append(key)
+        if key != "id":
+            keys.append(f"{key}_raw")
+    return keys
+
+
+def get_device_records(container, record_keys, postgrest):
     """Fetch device asset records from Knack
 
+    Only the given record keys are selected, so that postgrest does not send the
+    entirety of each record.
+
     Args:
         container (str): a Knack object or view key
+        record_keys (list): the Knack record keys to fetch (see get_record_keys)
         postgrest (pypgrest.Postgrest): a Postgrest client
 
     Returns:
-        list: a list of Knackpy.records
+        list: a list of Knack record dicts
     """
     logger.debug("Getting records from knack-postgrest...")
-    records = postgrest.select(
+    return postgrest.select(
         resource="knack",
         params={
-            "select": "record",
+            "select": ",".join(f"record->{key}" for key in record_keys),
             "app_id": f"eq.{KNACK_APP_ID}",
             "container_id": f"eq.{container}",
             "order": "updated_at",
         },
     )
-    return [r.get("record") for r in records]
 
 
 def get_knack_metadata(postgrest):
@@ -121,27 +193,96 @@ def get_knack_metadata(postgrest):
     return metadata_record[0]["metadata"]
 
 
-def format_device_records(records, container, metadata):
+def make_formatter(field_def):
+    """Create a function which formats a single field of a Knack record.
+
+    Values are handled as knackpy.Record does: the raw value is formatted, except for
+    field types where knackpy relies on Knack's own formatted value. Empty strings and
+    lists are treated as None.
+
+    Args:
+        field_def (knackpy.fields.FieldDef): the field's definition
+
+    Returns:
+        function: a function which accepts a knack record dict and returns the field's
+            formatted value
+    """
+    key = field_def.key
+    raw_key = f"{key}_raw"
+    formatter = field_def.formatter
+    use_knack_format = field_def.use_knack_format
+
+    def format_field(record):
+        value = record.get(raw_key)
+        if value is None:
+            value = record.get(key)
+        if value == "" or value == []:
+            value = None
+        knack_formatted = record.get(key) if use_knack_format else None
+        try:
+            return formatter(knack_formatted or value)
+        except AttributeError:
+            # thrown when value is None
+            return value
+
+    return format_field
+
+
+def get_field_formatters(field_keys, metadata):
+    """Build a formatter for each of the given Knack fields from the app's metadata.
+
+    This avoids constructing a knackpy.App, which parses the definition of every field
+    in the app, and formatting each record through knackpy's generic Record class.
+
+    Args:
+        field_keys (iterable): the Knack field keys to be formatted
+        metadata (dict): the Knack app's metadata
+
+    Raises:
+        ValueError: if a field is missing from the metadata or is a date field, which
+            would require knackpy's timezone handling
+
+    Returns:
+        dict: a dict of Knack field keys and their formatter functions
+    """
+    field_metadata = {
+        field["key"]: field
+        for obj in metadata["application"]["objects"]
+        for field in obj["fields"]
+    }
+    formatters = {}
+    for key in field_keys:
+        if key == "id":
+            field = {"name": "id", "type": "id"}
+        else:
+            try:
+                field = field_metadata[key]
+            except KeyError:
+                raise ValueError(f"Field {key} not found in Knack metadata")
+        if field["type"] == "date_time":
+            raise ValueError(f"Unsupported field type for field {key}: date_time")
+        field_def = FieldDef(key=key, name=field["name"], type=field["type"], obj=None)
+        formatters[key] = make_formatter(field_def)
+    return formatters
+
+
+def format_device_records(records, formatters):
     """Format knack record values.
 
     Without this, we may have non-humanized values for records. E.g. the raw location_name
         field typically has html markup—an artifact of Knack connection fields.
 
     Args:
-        records (list): a list of knackpy.Records
-        container (str): the Knack source container (object or view key)
-        metadata (dict): the Knack app's metadata
+        records (list): a list of knack record dicts
+        formatters (dict): a dict of Knack field keys and their formatter functions
+            (see get_field_formatters). Only these fields are returned.
 
     Returns:
         list: a list of knack record's with formatted values
     """
     logger.debug("Formatting Knack record values...")
-    # create our knack app and load metadata (this avoids a Knack api call)
-    app = knackpy.App(app_id=KNACK_APP_ID, metadata=metadata)
-    # load our records into the app
-    app.data[container] = records
-    # call record.get() to make use of knackpy's formatting features
-    return [record.format(keys=False) for record in app.get(container)]
+    formatters = tuple(formatters.items())
+    return [{key: fmt(record) for key, fmt in formatters} for record in records]
 
 
 def log_results(results):
@@ -163,29 +304,46 @@ def validate_results(results):
     Raises:
         ValueError: if any dict fails validation.
     """
-    v = utils.get_validator()
-    for row in results:
-        if not v.validate(row):
-            raise ValueError(f"Row failed validation: {v.errors}")
+    validate = utils.get_fast_validator()
+    try:
+        validate(results)
+    except fastjsonschema.JsonSchemaException as e:
+        raise ValueError(f"Row failed validation: {e.message}")
 
 
 async def main(*, device_type, env, workers, timeout):
     config = next(d for d in CONFIG if d["device_type"] == device_type)
 
-    # fetch and format knack records
-    postgrest = Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+    # fetch knack records and metadata concurrently. a pypgrest client holds the state
+    # of its last request, so each thread gets its own client
     container = config["container"]
-    device_records_raw = get_device_records(container, postgrest)
-    knack_metadata = get_knack_metadata(postgrest)
-    device_records = format_device_records(
-        device_records_raw, container, knack_metadata
+    record_keys = get_record_keys(config["fields"])
+    loop = asyncio.get_running_loop()
+    device_records_raw, knack_metadata = await asyncio.gather(
+        loop.run_in_executor(
+            None,
+            get_device_records,
+            container,
+            record_keys,
+            Postgrest(PGREST_ENDPOINT, token=PGREST_JWT),
+        ),
+        loop.run_in_executor(
+            None, get_knack_metadata, Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+        ),
     )
 
+    # format knack records
+    formatters = get_field_formatters(config["fields"].values(), knack_metadata)
+    device_records = format_device_records(device_records_raw, formatters)
+
     # construct Device instances
+    map_fields = get_field_mapper(config["fields"])
+    # each record ID is suffixed with the run's timestamp
+    batch_ts_ms = time.time_ns() // 1_000_000
     devices = []
     for d in device_records:
         try:
-            device = construct_device(d, device_type, config["fields"], timeout)
+            device = construct_device(d, device_type, map_fields, timeout, batch_ts_ms)
         except ValueError:
             # raised if required fields (ip_address, device_id) are missing or None
             continue
@@ -193,36 +351,38 @@ async def main(*, device_type, env, workers, timeout):
 
     logger.debug(f"{len(devices)} devices to ping")
 
-    # create FIFO queue and load Devices
-    queue = asyncio.Queue()
+    # ping all devices, with at most `workers` pings in flight at once. all pings
+    # share a single ICMP socket, so no more may be in flight than its receive buffer
+    # has room to queue replies for
+    with IcmpPinger() as pinger:
+        if workers is None:
+            workers = min(NUM_WORKERS_DEFAULT, pinger.max_in_flight)
+        elif workers > pinger.max_in_flight:
+            logger.warning(
+                f"Limiting workers to {pinger.max_in_flight}: the ICMP receive buffer "
+                f"is {pinger.rcvbuf} bytes. Raise net.core.rmem_max to allow more"
+            )
+            workers = pinger.max_in_flight
+        logger.debug(f"Pinging with {workers} workers")
+        semaphore = asyncio.Semaphore(workers)
+        await asyncio.gather(*(ping_with_retry(d, pinger, semaphore) for d in devices))
+
+    # all devices in the batch share one timestamp
+    now = datetime.now(timezone.utc)
+    timestamp = utils.format_socrata_timestamp(now)
     for d in devices:
-        await queue.put(d)
-
-    # create queue worker-tasks
-    tasks = []
-    for i in range(workers):
-        task = asyncio.create_task(worker(queue))
-        tasks.append(task)
-
-    # run tasks until queue is empty
-    await queue.join()
-
-    # cancel worker tasks to clear them from memory
-    for task in tasks:
-        task.cancel()
-    await asyncio.gather(*tasks, return_exceptions=True)
+        d.timestamp = timestamp
 
     # dictify-devices and validate data
-    results = [d.__dict__ for d in devices]
+    results = [d.to_record() for d in devices]
     validate_results(results)
     log_results(results)
 
     # upload to S3
     logger.debug("Uploading JSON to S3...")
-    now = datetime.now(timezone.utc)
     filename = utils.format_filename(env=env, device_type=device_type, dt=now)
     s3 = boto3.client("s3")
-    s3.put_object(Body=json.dumps(results), Bucket=BUCKET, Key=filename)
+    s3.put_object(Body=orjson.dumps(results), Bucket=BUCKET, Key=filename)
     return
 
 
@@ -258,8 +418,7 @@ if __name__ == "__main__":
         "-w",
         "--workers",
         type=int,
-        default=NUM_WORKERS_DEFAULT,
-        help=f"Number of concurrent workers",
+        help=f"Number of concurrent workers. Defaults to {NUM_WORKERS_DEFAULT}, or fewer if the ICMP receive buffer is too small",
     )
 
     parser.add_argument(
@@ -276,4 +435,7 @@ if __name__ == "__main__":
         level=logging.DEBUG if args.verbose else logging.INFO,
     )
 
+    if uvloop:
+        uvloop.install()
+
     asyncio.run(main(device_type=args.device_type, env=args.env, workers=args.workers, timeout=args.timeout))
@@ -1,7 +1,24 @@
-MAX_ATTEMPTS = 4
-NUM_WORKERS_DEFAULT = 300
-TIMEOUT_DEFAULT = 30
+# a device which does not reply within TIMEOUT_DEFAULT seconds is retried, up to
+# MAX_ATTEMPTS times. several short probes give the same confidence that a device is
+# offline as one long probe, since replies on our network arrive well within a second,
+# but they free up a worker much sooner
+MAX_ATTEMPTS = 3
+# at most this many pings are in flight at once. replies queue in one socket buffer,
+# which on a stock kernel (net.core.rmem_max = 212992) has room for about 256
+NUM_WORKERS_DEFAULT = 250
+TIMEOUT_DEFAULT = 5
+# seconds to wait before the first retry. the wait doubles with each retry
+RETRY_BACKOFF = 0.5
 SOCRATA_RESOURCE_ID = {"dev": "j9p3-9u87", "prod": "pj7k-98z2"}
+# max number of rows to send to Socrata in a single upsert
+SOCRATA_BATCH_ROWS = 10000
+# number of S3 files to download concurrently when publishing to Socrata
+DOWNLOAD_WORKERS = 8
+# size of the S3 client's connection pool. must cover concurrent listing and downloads
+S3_MAX_POOL_CONNECTIONS = 64
+# local file in which socrata_pub.py records the S3 files it has already published.
+# each environment and device type has its own file
+WATERMARK_FILE = "~/.atd_signal_comms_watermark_{env}_{device_type}.json"
 DATE_FORMAT_FILE = "%Y-%m-%d"
 DATE_FORMAT_SOCRATA = "%Y-%m-%dT%H:%M:%S"
 STATUS_CODES = {
@@ -3,15 +3,24 @@
 Download comm status files and publish to Socrata
 """
 import argparse
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timezone, timedelta
-import json
 import logging
 import os
-
-import boto3
-import sodapy
-
-from settings import DATE_FORMAT_FILE, SOCRATA_RESOURCE_ID
+from typing import Iterable, Iterator
+
+import fastjsonschema
+import orjson
+
+from settings import (
+    DATE_FORMAT_FILE,
+    DOWNLOAD_WORKERS,
+    S3_MAX_POOL_CONNECTIONS,
+    SOCRATA_BATCH_ROWS,
+    SOCRATA_RESOURCE_ID,
+    WATERMARK_FILE,
+)
 import utils
 
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
@@ -23,62 +32,157 @@ SOCRATA_TOKEN = os.getenv("SOCRATA_TOKEN")
 
 
 def get_socrata_client():
+    """Create the Socrata client which is shared by all upserts.
+
+    Its session keeps a small pool of connections alive between upserts, and retries
+    requests which fail with a write conflict (409), rate limit (429) or service
+    unavailable (503) error. Upserts are safe to retry, because records are keyed by
+    their ID.
+    """
+    # imported here rather than at module level to keep CLI start-up (e.g. --help) fast
+    from requests.adapters import HTTPAdapter
+    import sodapy
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[409, 429, 503],
+        allowed_methods=None,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
     return sodapy.Socrata(
         "datahub.austintexas.gov",
         SOCRATA_TOKEN,
         username=SOCRATA_USER,
         password=SOCRATA_PW,
         timeout=60,
+        session_adapter={"prefix": "https://", "adapter": adapter},
+    )
+
+
+def get_s3_client():
+    """Create an S3 client which is shared by all S3 requests.
+
+    The connection pool is sized for the concurrent listing and download threads, and
+    throttled requests are retried with adaptive backoff.
+    """
+    # imported here rather than at module level to keep CLI start-up (e.g. --help) fast
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": 5, "mode": "adaptive"},
     )
+    return boto3.client("s3", config=config)
 
 
-def get_files_to_download(bucket_prefixes: list, files_todo: list, client) -> list:
-    """Retrieve a list of all file paths from S3 which exist within the provided
-        files_todo list.
+def list_prefix(client, prefix: str, files_todo: set) -> list:
+    """List the objects under a single bucket prefix which exist in files_todo.
+
+    Listing is narrowed server-side to start at the earliest key in files_todo, and
+    stops once keys pass the latest. Usually this takes a single request. S3 lists
+    keys in lexicographic order, which for our file names is also date order.
+
+    Args:
+        client (botocore.client.S3): the boto client
+        prefix (str): the prefix used to filter objects in the bucket
+        files_todo (set): a set of S3 object path strings
+
+    Returns:
+        list: a list of (S3 object path, ETag) tuples of the objects under the prefix
+            which exist in files_todo.
+    """
+    keys_todo = sorted(key for key in files_todo if key.startswith(prefix))
+    if not keys_todo:
+        return []
+    first_key, last_key = keys_todo[0], keys_todo[-1]
+    # the file name without its extension sorts immediately before the file itself
+    start_after = first_key.rsplit(".", 1)[0]
+
+    # the keys we want fall within a single page, so size the first request to just
+    # cover them. only page on through the prefix if that turns out to be too small
+    params = {
+        "Bucket": BUCKET,
+        "Prefix": prefix,
+        "StartAfter": start_after,
+        "MaxKeys": min(len(keys_todo) * 2, 1000),
+    }
+    files = []
+    while True:
+        response = client.list_objects_v2(**params)
+        for obj in response.get("Contents", []):
+            key = obj["Key"]
+            if key > last_key:
+                return files
+            if key in files_todo:
+                files.append((key, obj["ETag"]))
+        if not response.get("IsTruncated"):
+            return files
+        params["ContinuationToken"] = response["NextContinuationToken"]
+        params["MaxKeys"] = 1000
+
+
+def get_files_to_download(bucket_prefixes: Iterable, files_todo: set, client) -> dict:
+    """Retrieve all file paths and ETags from S3 which exist within the provided
+        files_todo set.
 
     Files are stored in S3 under the pattern <env>/<device_type>/<year>/<month>. To find a
     file for a specific day in S3, we first need to identify its month subdirectory, then
-    we can list files in that subdirectory to see if the file is present.
+    we can list files in that subdirectory to see if the file is present. Each
+    subdirectory is listed concurrently.
 
     Args:
-        bucket_prefixes (list): a list of prefix strings which will be used to filter
-            objects in the bucket. This will be a lists of year/month paths which encompass
-            the entire range of dates requested.
-        files_todo (list): a list of S3 object path strings
+        bucket_prefixes (iterable): prefix strings which will be used to filter objects
+            in the bucket. These are the year/month paths which encompass the entire
+            range of dates requested. Each prefix is submitted for listing as soon as
+            it is generated.
+        files_todo (set): a set of S3 object path strings
         client (botocore.client.S3): the boto client (i could find the right import path to include a type hint :/ )
 
     Returns:
-        list: a list of S3 object paths which exist in both files_todo and the S3 bucket.
+        dict: the S3 object paths which exist in both files_todo and the S3 bucket,
+            in sorted order, mapped to their ETags.
     """
-    paginator = client.get_paginator("list_objects")
     files = []
 
-    for year_month_prefix in bucket_prefixes:
-        page_iterator = paginator.paginate(Bucket=BUCKET, Prefix=year_month_prefix)
-        for page in page_iterator:
-            contents = page.get("Contents", [])
-            files.extend([obj["Key"] for obj in contents if obj["Key"] in files_todo])
-    return files
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = [
+            executor.submit(list_prefix, client, prefix, files_todo)
+            for prefix in bucket_prefixes
+        ]
+        for future in as_completed(futures):
+            files.extend(future.result())
+    # prefixes complete in any order
+    files.sort()
+    return dict(files)
 
 
-def date_range(date_min: datetime, date_max: datetime) -> list:
+def date_range(date_min: datetime, date_max: datetime) -> Iterator[datetime]:
     """
     Args:
         date_min (datetime.datetime): the minimum date in the range
         date_max (datetime.datetime): the maximum date in the range
 
-    Returns:
-        list: a list of datetime objects included in the given min/max dates
+    Yields:
+        datetime.datetime: each date included in the given min/max dates
     """
-    range_delta = date_max - date_min
-    return [date_min + timedelta(days=i) for i in range(range_delta.days + 1)]
+    one_day = timedelta(days=1)
+    dt = date_min
+    while dt <= date_max:
+        yield dt
+        dt += one_day
 
 
-def parse_date(date_str: str, fmt: str, tzinfo: timezone = timezone.utc) -> datetime:
-    """
+def parse_date(date_str: str, tzinfo: timezone = timezone.utc) -> datetime:
+    """Parse a date in DATE_FORMAT_FILE (YYYY-MM-DD).
+
+    The date is split on its separators rather than parsed with strptime. As with
+    strptime, the month and day may be given without zero padding.
+
     Args:
-        date_str (str): an input date matching the given input format
-        fmt (str, optional): The formatting template.
+        date_str (str): an input date formatted as YYYY-MM-DD
         tzinfo (datetime.timezone, optional): The timezone of the input date. Defaults to timezone.utc.
 
     Raises:
@@ -88,14 +192,24 @@ def parse_date(date_str: str, fmt: str, tzinfo: timezone = timezone.utc) -> date
         datetime.datetime: The datetime object.
     """
     try:
-        return datetime.strptime(date_str, fmt).replace(tzinfo=tzinfo)
+        year, month, day = date_str.split("-")
+        if not (
+            len(year) == 4
+            and 1 <= len(month) <= 2
+            and 1 <= len(day) <= 2
+            and (year + month + day).isdigit()
+        ):
+            raise ValueError
+        return datetime(int(year), int(month), int(day), tzinfo=tzinfo)
     except ValueError:
         raise ValueError(f"Unable to parse date '{date_str}' as YYYY-MM-DD")
-    except TypeError:
+    except (AttributeError, TypeError):
         raise ValueError(f"Invalid date string input: {type(date_str)}")
 
 
-def get_bucket_prefixes(device_type: str, env: str, dates_todo: list) -> list:
+def get_bucket_prefixes(
+    device_type: str, env: str, date_min: datetime, date_max: datetime
+) -> Iterator[str]:
     """Generate a list of "prefixes" to be used to filter objects in the S3 bucket.
 
     Files are stored in S3 under the pattern <env>/<device_type>/<year>/<month>. To find a
@@ -105,29 +219,112 @@ def get_bucket_prefixes(device_type: str, env: str, dates_todo: list) -> list:
     Args:
         device_type (str): The type of device
         env (str): The environment (dev or prod)
-        dates_todo (list): A list of datetime objects
+        date_min (datetime.datetime): the minimum date in the range
+        date_max (datetime.datetime): the maximum date in the range
 
-    Returns:
-        list: a list of bucket prefixes that encompass all files for the requested range.s
+    Yields:
+        str: each bucket prefix of the months which encompass the requested range, in
+            chronological order
     """
-    prefixes = [f"{env}/{device_type}/{d.year}/{d.month}" for d in dates_todo]
-    prefixes = list(set(prefixes))
-    prefixes.sort()
-    return prefixes
+    year, month = date_min.year, date_min.month
+    while (year, month) <= (date_max.year, date_max.month):
+        yield f"{env}/{device_type}/{year}/{month}/"
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+
 
+def download_rows(client, key):
+    """Download a JSON file from S3 and parse its records.
 
-def download_file(client, key):
-    """Download a file from S3
+    The response bytes are handed straight to orjson, without being decoded to a str
+    first.
 
     Args:
         client (botocore.client.S3): the boto client
         key (str): the S3 object key
     Returns:
-        bytes: the encoded file data
+        list: the file's records
+    """
+    logger.debug("Downloading %s...", key)
+    body = client.get_object(Bucket=BUCKET, Key=key)["Body"]
+    try:
+        return orjson.loads(body.read())
+    finally:
+        body.close()
+
+
+def download_all(client, keys, workers=DOWNLOAD_WORKERS):
+    """Download and parse S3 files concurrently, yielding each file's records as its
+    download completes.
+
+    At most 2 * workers files are downloading or awaiting the consumer at once, which
+    bounds memory use when the consumer is slower than the downloads.
+
+    Args:
+        client (botocore.client.S3): the boto client
+        keys (list): the S3 object keys to download
+        workers (int, optional): the number of concurrent downloads
+
+    Yields:
+        tuple: the S3 object key and its records. Files are yielded in order of
+            completion.
+    """
+    keys = iter(keys)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(download_rows, client, key): key
+            for key in itertools.islice(keys, workers * 2)
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+                key = next(keys, None)
+                if key:
+                    pending[executor.submit(download_rows, client, key)] = key
+
+
+def get_watermark_path(env, device_type):
+    """Get the path of the watermark file for an environment and device type.
+
+    Args:
+        env (str): The environment (dev or prod)
+        device_type (str): The type of device
+
+    Returns:
+        str: the watermark file path
     """
-    logger.debug(f"Downloading {key}...")
-    response = client.get_object(Bucket=BUCKET, Key=key)
-    return response["Body"].read()
+    return os.path.expanduser(WATERMARK_FILE.format(env=env, device_type=device_type))
+
+
+def load_watermark(path):
+    """Load the record of which S3 files have already been published.
+
+    Args:
+        path (str): the watermark file path
+
+    Returns:
+        dict: S3 object paths mapped to the ETag of the object when it was last
+            published. Empty if the watermark file does not exist.
+    """
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermark(watermark, path):
+    """Save the record of which S3 files have been published. The file is replaced
+    atomically, so an interrupted save leaves the previous watermark intact.
+
+    Args:
+        watermark (dict): S3 object paths mapped to the ETag of the published object
+        path (str): the watermark file path
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(watermark))
+    os.replace(tmp_path, path)
 
 
 def remove_ips(rows):
@@ -140,35 +337,93 @@ def remove_ips(rows):
         d.pop("ip_address")
 
 
-def main(device_type, env, start, end):
-    date_min = parse_date(start, DATE_FORMAT_FILE)
-    date_max = parse_date(end, DATE_FORMAT_FILE)
-    dates_todo = date_range(date_min, date_max)
+def validate_rows(rows):
+    """Validate downloaded records against our schema definition.
 
-    logger.debug(
-        f"Processing {dates_todo[0].strftime(DATE_FORMAT_FILE)} to {dates_todo[-1].strftime(DATE_FORMAT_FILE)}"
-    )
+    Args:
+        rows (list): list of record dicts, as uploaded to S3 by run_comm_check.py
 
-    # generate a list of file names that fall within the given range
-    files_todo = [
+    Raises:
+        ValueError: if any record fails validation.
+    """
+    validate = utils.get_fast_validator()
+    try:
+        validate(rows)
+    except fastjsonschema.JsonSchemaException as e:
+        raise ValueError(f"Row failed validation: {e.message}")
+
+
+def upsert_batch(socrata_client, resource_id, rows):
+    """Upsert rows to Socrata in chunks of at most SOCRATA_BATCH_ROWS
+
+    Args:
+        socrata_client (sodapy.Socrata): the Socrata client
+        resource_id (str): the Socrata dataset identifier
+        rows (list): list of record dicts
+    """
+    for i in range(0, len(rows), SOCRATA_BATCH_ROWS):
+        chunk = rows[i : i + SOCRATA_BATCH_ROWS]
+        logger.debug("Upserting %s rows to Socrata...", len(chunk))
+        socrata_client.upsert(resource_id, chunk)
+
+
+def main(device_type, env, start, end, validate=False, force=False):
+    date_min = parse_date(start)
+    date_max = parse_date(end)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Processing %s to %s",
+            date_min.strftime(DATE_FORMAT_FILE),
+            date_max.strftime(DATE_FORMAT_FILE),
+        )
+
+    # generate a set of file names that fall within the given range
+    files_todo = {
         utils.format_filename(env=env, device_type=device_type, dt=dt)
-        for dt in dates_todo
-    ]
+        for dt in date_range(date_min, date_max)
+    }
 
-    # generate a list of bucket prefixes (folders) that would contain files in the range
-    bucket_prefixes = get_bucket_prefixes(device_type, env, dates_todo)
+    # generate the bucket prefixes (folders) that would contain files in the range
+    bucket_prefixes = get_bucket_prefixes(device_type, env, date_min, date_max)
 
     logger.debug(
-        f"Checking for S3 objects from {bucket_prefixes[0]} to {bucket_prefixes[-1]}"
+        "Checking for S3 objects from %s/%s to %s/%s",
+        date_min.year,
+        date_min.month,
+        date_max.year,
+        date_max.month,
     )
 
     # retrieve from S3 a list of actually existing objects which meet our date criteria
-    client = boto3.client("s3")
+    client = get_s3_client()
     files_to_download = get_files_to_download(bucket_prefixes, files_todo, client)
 
-    logger.debug(f"{len(files_to_download)} found in bucket")
+    logger.debug("%s found in bucket", len(files_to_download))
+
+    # each day's file is overwritten by every comm check run on that day, so a file is
+    # only skipped if it has not changed since it was last published
+    watermark_path = get_watermark_path(env, device_type)
+    watermark = load_watermark(watermark_path)
+    # forget files dated before the requested range, so that the watermark only grows
+    # with the range of each run. file names are dates, which sort chronologically
+    first_file = utils.format_filename(env=env, device_type=device_type, dt=date_min)
+    first_file = first_file.rsplit("/", 1)[1]
+    watermark = {
+        key: etag
+        for key, etag in watermark.items()
+        if key.rsplit("/", 1)[1] >= first_file
+    }
+    if not force:
+        files_to_download = {
+            key: etag
+            for key, etag in files_to_download.items()
+            if watermark.get(key) != etag
+        }
+        logger.debug("%s new or changed since last publish", len(files_to_download))
 
     if not files_to_download:
+        save_watermark(watermark, watermark_path)
         return
 
     # publish to socrata
@@ -176,12 +431,40 @@ def main(device_type, env, start, end):
 
     socrata_client = get_socrata_client()
 
-    for key in files_to_download:
-        json_file = download_file(client, key)
-        rows = json.loads(json_file.decode())
-        remove_ips(rows)
-        logger.debug(f"Upserting {key} to Socrata...")
-        socrata_client.upsert(resource_id, rows)
+    # files are downloaded concurrently while rows are upserted. rows from multiple
+    # files are upserted together in chunks of SOCRATA_BATCH_ROWS, and rows which do
+    # not fill a chunk are carried over to the next, so that only the final upsert is
+    # short. upserts run one at a time to avoid Socrata write conflicts
+    # a file is added to the watermark once all of its rows have been upserted. the
+    # watermark is saved even if publishing fails part way through
+    batch = []
+    # (key, index in batch just past the file's last row) of each file in the batch
+    batch_keys = []
+    try:
+        for key, rows in download_all(client, files_to_download):
+            if validate:
+                validate_rows(rows)
+            remove_ips(rows)
+            batch.extend(rows)
+            batch_keys.append((key, len(batch)))
+            if len(batch) >= SOCRATA_BATCH_ROWS:
+                num_sent = len(batch) - len(batch) % SOCRATA_BATCH_ROWS
+                upsert_batch(socrata_client, resource_id, batch[:num_sent])
+                watermark.update(
+                    (k, files_to_download[k])
+                    for k, end in batch_keys
+                    if end <= num_sent
+                )
+                batch = batch[num_sent:]
+                batch_keys = [
+                    (k, end - num_sent) for k, end in batch_keys if end > num_sent
+                ]
+
+        if batch_keys:
+            upsert_batch(socrata_client, resource_id, batch)
+            watermark.update((k, files_to_download[k]) for k, _ in batch_keys)
+    finally:
+        save_watermark(watermark, watermark_path)
 
     return
 
@@ -219,6 +502,18 @@ if __name__ == "__main__":
         help=f"End (in UTC) of oldest records to be fetched YYYY-MM-DD). Defaults to today",
     )
 
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help=f"Validate records against the schema before publishing",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=f"Publish all files in the date range, including those which have not changed since they were last published",
+    )
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -233,4 +528,11 @@ if __name__ == "__main__":
         level=logging.DEBUG if args.verbose else logging.INFO,
     )
 
-    main(args.device_type, args.env, args.start, args.end)
+    main(
+        args.device_type,
+        args.env,
+        args.start,
+        args.end,
+        validate=args.validate,
+        force=args.force,
+    )
@@ -1,24 +1,76 @@
+import functools
 import logging
 import sys
 
-import cerberus
+import fastjsonschema
 from config import CONFIG, SCHEMA
-from settings import DATE_FORMAT_FILE
 
 
 def get_logger(name, level):
-    """Return a module logger that streams to stdout"""
+    """Return a module logger that streams to stdout. The stdout handler is only added
+    once, no matter how many times the logger is requested."""
     logger = logging.getLogger(name)
-    formatter = logging.Formatter(fmt="%(asctime)s %(levelname)s: %(message)s")
-    handler = logging.StreamHandler(stream=sys.stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if not logger.handlers:
+        formatter = logging.Formatter(fmt="%(asctime)s %(levelname)s: %(message)s")
+        handler = logging.StreamHandler(stream=sys.stdout)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        logger.propagate = False
     logger.setLevel(level)
     return logger
 
 
-def get_validator():
-    return cerberus.Validator(SCHEMA, require_all=True)
+def to_json_schema(schema):
+    """Translate a schema definition into an equivalent JSON Schema.
+
+    The schema uses Cerberus-style rules (`type`, `nullable`, `allowed`). Every field
+    is required and no additional fields are allowed.
+
+    Args:
+        schema (dict): a schema definition (see config.SCHEMA)
+
+    Returns:
+        dict: the JSON Schema definition
+    """
+    properties = {}
+    for key, rules in schema.items():
+        types = rules["type"]
+        types = list(types) if isinstance(types, list) else [types]
+        prop = {}
+        if "allowed" in rules:
+            # sorted, so the generated schema does not depend on set iteration order
+            prop["enum"] = sorted(rules["allowed"])
+        if rules.get("nullable"):
+            types.append("null")
+            if "enum" in prop:
+                prop["enum"].append(None)
+        prop["type"] = types
+        properties[key] = prop
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(schema.keys()),
+        "additionalProperties": False,
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def get_fast_validator():
+    """Compile the schema into a function which validates a list of rows in a single
+    call. The result is cached, so the schema is only compiled once per process.
+
+    Returns:
+        function: a callable which raises fastjsonschema.JsonSchemaException if any
+            row of its input does not match the schema
+    """
+    # draft-04, where "integer" rejects floats such as 1.0, as Cerberus did
+    return fastjsonschema.compile(
+        {
+            "$schema": "http://json-schema.org/draft-04/schema#",
+            "type": "array",
+            "items": to_json_schema(SCHEMA),
+        }
+    )
 
 
 def supported_device_types():
@@ -31,15 +83,34 @@ def supported_device_types():
 
 
 def format_filename(*, device_type, env, dt):
-    """Format a file name for S3 storage
+    """Format a file name for S3 storage. The file name is the date formatted as
+    DATE_FORMAT_FILE (YYYY-MM-DD), built without the overhead of strftime.
 
     Args:
         env (str): the environment - test or prod
         device_type (str): the device type name
+        dt (datetime.datetime): the date of the file
 
     Returns:
         str: a path + filename to be used as the S3 bucket path
     """
     return (
-        f"{env}/{device_type}/{dt.year}/{dt.month}/{dt.strftime(DATE_FORMAT_FILE)}.json"
+        f"{env}/{device_type}/{dt.year}/{dt.month}/"
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}.json"
+    )
+
+
+def format_socrata_timestamp(dt):
+    """Format a datetime as a Socrata timestamp string. Equivalent to
+    `dt.strftime(DATE_FORMAT_SOCRATA)` but without the overhead of strftime.
+
+    Args:
+        dt (datetime.datetime): a datetime instance
+
+    Returns:
+        str: the timestamp, formatted as YYYY-MM-DDTHH:MM:SS
+    """
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+        f"T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
     )